@@ -67,6 +67,14 @@ class Config:
         Value -1 means setting it to 772 when using UMI, or 1796 otherwise.
     no_orphan : bool, default True
         If `False`, do not skip anomalous read pairs.
+    bam_decomp_threads : int, default 2
+        Number of threads used for decompressing the input BAM file(s),
+        in each process.
+        They are extra threads on top of `ncores`, i.e., up to
+        ``ncores * bam_decomp_threads`` more threads in total.
+        The threads are shared by the BAM files, as each opened file has
+        its own thread pool; files get no extra threads if there are more
+        files than threads.
     """
     def __init__(self):
         # defaults : DefaultConfig
@@ -100,6 +108,8 @@ class Config:
         self.excl_flag = -1
         self.no_orphan = self.defaults.NO_ORPHAN
 
+        self.bam_decomp_threads = self.defaults.BAM_DECOMP_THREADS
+
         # derived parameters.
 
         # barcodes : list of str or None
@@ -206,6 +216,9 @@ class Config:
         s += "%sno_orphan = %s\n" % (prefix, self.no_orphan)
         s += "%s\n" % prefix
 
+        s += "%sbam_decomp_threads = %d\n" % (prefix, self.bam_decomp_threads)
+        s += "%s\n" % prefix
+
         # derived parameters.
         
         s += "%snumber_of_BAMs = %d\n" % (prefix, len(self.sam_fn_list) if \
@@ -264,6 +277,10 @@ class DefaultConfig:
         self.EXCL_FLAG_XUMI = 1796
         self.NO_ORPHAN = True
 
+        # keep it small, as each of the `ncores` processes opens every
+        # input BAM file, each with its own thread pool.
+        self.BAM_DECOMP_THREADS = 2
+
 
 if __name__ == "__main__":
     conf = Config()
@@ -10,8 +10,10 @@ from logging import debug, error, info
 from .mcount_ab import MCount as ABFeatureMCount
 from .mcount_feature import MCount as FeatureMCount
 from .mcount_snp import MCount as SNPMCount
-from ..utils.sam import check_read, sam_fetch
-from ..utils.zfile import zopen, ZF_F_GZIP
+from .sam import SAMReader
+from ..utils.base import shm_load
+from ..utils.sam import BAMReadahead
+from ..utils.zfile import zopen, ZF_F_PLAIN
 
 
 # NOTE: 
@@ -41,17 +43,34 @@ def fc_features(thdata):
     conf = thdata.conf
     thdata.ret = -1
 
+    # htslib creates one thread pool per opened file, hence the threads are
+    # divided among the files, e.g., none for one BAM per cell.
+    # Similarly, readahead opens one more file descriptor per BAM and costs
+    # system calls for every BAM after each feature; it is skipped when
+    # there are many BAMs.
     sam_list = []
+    sam_ra_list = []
+    nthreads = max(conf.bam_decomp_threads // len(conf.sam_fn_list), 1)
+    use_ra = len(conf.sam_fn_list) <= BAM_READAHEAD_MAX_FILES
     for sam_fn in conf.sam_fn_list:
-        sam = pysam.AlignmentFile(sam_fn, "r")
+        sam = pysam.AlignmentFile(sam_fn, "r", threads = nthreads)
         sam_list.append(sam)
+        if use_ra:
+            sam_ra_list.append(BAMReadahead(sam_fn, sam))
 
     reg_list = None
-    with open(thdata.reg_obj_fn, "rb") as fp:
-        reg_list = pickle.load(fp)
-    os.remove(thdata.reg_obj_fn)
-
-    fp_ale = {ale: zopen(fn, "wt", ZF_F_GZIP, is_bytes = False) \
+    if thdata.reg_obj_shm is not None:
+        reg_list = shm_load(*thdata.reg_obj_shm)
+    else:
+        with open(thdata.reg_obj_fn, "rb") as fp:
+            reg_list = pickle.load(fp)
+        os.remove(thdata.reg_obj_fn)
+
+    sam_reader = SAMReader(sam_list, conf)
+
+    # the per-thread matrices are merged into a plain file by the main
+    # process, hence compressing them is wasted work.
+    fp_ale = {ale: zopen(fn, "wt", ZF_F_PLAIN, is_bytes = False) \
                 for ale, fn in thdata.out_ale_fns.items()}
     alleles = thdata.out_ale_fns.keys()
 
@@ -67,25 +86,35 @@ def fc_features(thdata):
                 (thdata.idx, reg.name))
 
         ret, reg_ale_cnt = \
-            fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf)
+            fc_fet1(reg, alleles, sam_reader, snp_mcnt, ab_mcnt, mcnt, conf)
         if ret < 0 or reg_ale_cnt is None:
-            error("errcode -9 (%s)." % reg.name)
-            raise RuntimeError
-
-        str_ale = {ale:"" for ale in alleles}
-        for i, smp in enumerate(conf.samples):
-            nu_ale = {ale:reg_ale_cnt[ale][smp] for ale in alleles}
-            if np.sum([v for v in nu_ale.values()]) <= 0:
+            # any failed feature fails the whole run, hence stop here rather
+            # than counting the remaining features; the main process
+            # reports the failed features of all processes.
+            error("[Thread-%d] counting feature '%s' failed; errcode %d." % \
+                (thdata.idx, reg.name, ret))
+            thdata.err_reg.append((reg.name, ret))
+            break
+        for ale in alleles:
+            ale_cnt = reg_ale_cnt[ale]
+            idx = np.nonzero(ale_cnt > 0)[0]
+            if len(idx) <= 0:
                 continue
-            for ale in alleles:
-                if nu_ale[ale] > 0:
-                    str_ale[ale] += "%d\t%d\t%d\n" % \
-                        (reg_idx + 1, i + 1, nu_ale[ale])
-                    thdata.nr_ale[ale] += 1
-
-        if np.any([len(s) > 0 for s in str_ale.values()]):
-            for ale in alleles:
-                fp_ale[ale].write(str_ale[ale])
+            lines = ["%d\t%d\t%d\n" % (reg_idx + 1, i + 1, n) for i, n in \
+                zip(idx.tolist(), ale_cnt[idx].tolist())]
+            fp_ale[ale].write("".join(lines))
+            thdata.nr_ale[ale] += len(idx)
+
+        # features are mostly processed in genomic order, hence the next
+        # feature is likely close to the end of the current one.
+        for sam_ra in sam_ra_list:
+            sam_ra.prefetch(reg.chrom)
+
+        # the reads of processed features are unlikely to be fetched again
+        # by this process; release their pages for the other processes.
+        if (reg_idx + 1) % BAM_RELEASE_INTERVAL == 0:
+            for sam_ra in sam_ra_list:
+                sam_ra.release()
 
         n_reg = reg_idx + 1
         frac_reg = n_reg / m_reg
@@ -98,17 +127,20 @@ def fc_features(thdata):
 
     for ale in alleles:
         fp_ale[ale].close()
+    for sam_ra in sam_ra_list:
+        sam_ra.close()
+    sam_ra_list.clear()
     for sam in sam_list:
         sam.close()
     sam_list.clear()
 
-    thdata.conf = None    # sam object cannot be pickled.
+    thdata.conf = None    # not needed by the main process; skip pickling.
     thdata.ret = 0
             
     return((0, thdata))
 
 
-def fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf):
+def fc_fet1(reg, alleles, sam_reader, snp_mcnt, ab_mcnt, mcnt, conf):
     """Feature counting for one feature.
 
     This function generates *allele x cell* counts for one feature, and output
@@ -123,8 +155,8 @@ def fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf):
         The feature to be counted.
     alleles : list of str
         A list of allele names.
-    sam_list : list of pysam.AlignmentFile
-        A list of file objects for input SAM/BAM files.
+    sam_reader : afc.sam.SAMReader
+        The object fetching reads from the input SAM/BAM files.
     snp_mcnt : afc.mcount_snp.MCount
         Counting object in SNP level.
     ab_mcnt : afc.mcount_ab.MCount
@@ -138,29 +170,25 @@ def fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf):
     -------
     int
         Return code. 0 if success, negative otherwise.
-    dict or None
+    dict of {str : numpy.ndarray} or None
         The *allele x cell* counts.
-        It is a two-layer dict, with "allele name (str)" and "cell ID (str)"
-        as keys, respectively, and "counts (int)" as values.
+        Keys are allele names, values are the counts (int) of all cells,
+        in the same order as `conf.samples`.
         None if error happens.
     """
-    if fc_ab(reg, sam_list, snp_mcnt, ab_mcnt, conf) < 0:
+    if fc_ab(reg, sam_reader.fetch_snps(reg), snp_mcnt, ab_mcnt, conf) < 0:
         return((-3, None))
     mcnt.add_feature(reg, ab_mcnt)
 
+    # keep the per-read loops free of numpy and config method calls (the
+    # MCount objects cache the cell and UMI tags); the per-feature
+    # aggregation below is where numpy is used.
+    use_barcodes = conf.use_barcodes()
     ret = smp = umi = ale_idx = None
-    for idx, sam in enumerate(sam_list):
-        itr = sam_fetch(sam, reg.chrom, reg.start, reg.end - 1)
-        if not itr:    
-            continue
-        for read in itr:
-            if check_read(read, conf) < 0:
-                continue
-            if conf.use_barcodes():
-                ret, smp, umi, ale_idx = mcnt.push_read(read)
-            else:
-                sample = conf.samples[idx]
-                ret, smp, umi, ale_idx = mcnt.push_read(read, sample)
+    for idx, reads in enumerate(sam_reader.fetch(reg)):
+        sample = None if use_barcodes else conf.samples[idx]
+        for read in reads:
+            ret, smp, umi, ale_idx = mcnt.push_read(read, sample)
             if ret < 0:
                 return((-5, None))
             elif ret > 0:    # read filtered.
@@ -171,15 +199,20 @@ def fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf):
     if mcnt.stat() < 0:
         return((-9, None))
     
-    reg_ale_cnt = {ale: {smp:0 for smp in conf.samples} for ale in alleles}
+    cnt = mcnt.hap_cnt
+    reg_ale_cnt = {
+        "A": cnt[:, 0].copy(),
+        "B": cnt[:, 1].copy(),
+        "D": cnt[:, 2].copy(),
+        "O": cnt[:, -1].copy(),
+        "U": cnt[:, -2] + cnt[:, -3]
+    }
+
     aln_fps = {ale: open(fn, "w") for ale, fn in reg.aln_fns.items()}
     ale_umi = None
-    for smp, scnt in mcnt.cell_cnt.items():
-        reg_ale_cnt["A"][smp] = scnt.hap_cnt[0]
-        reg_ale_cnt["B"][smp] = scnt.hap_cnt[1]
-        reg_ale_cnt["D"][smp] = scnt.hap_cnt[2]
-        reg_ale_cnt["O"][smp] = scnt.hap_cnt[-1]
-        reg_ale_cnt["U"][smp] = scnt.hap_cnt[-2] + scnt.hap_cnt[-3]
+    # cells without reads have no UMIs to output; keep the order of samples.
+    for smp in sorted(mcnt.hit_samples, key = mcnt.sample_idx.get):
+        scnt = mcnt.cell_cnt[smp]
         for ale, fp in aln_fps.items():
             if ale == "A":
                 ale_umi = scnt.umi_cnt[0]
@@ -200,7 +233,7 @@ def fc_fet1(reg, alleles, sam_list, snp_mcnt, ab_mcnt, mcnt, conf):
     return((0, reg_ale_cnt))
 
 
-def fc_ab(reg, sam_list, snp_mcnt, mcnt, conf):
+def fc_ab(reg, snp_reads, snp_mcnt, mcnt, conf):
     """Counting for allele A and B in feature level.
     
     This function generates UMI/read counts of allele "A" and "B" in each
@@ -215,8 +248,9 @@ def fc_ab(reg, sam_list, snp_mcnt, mcnt, conf):
     ----------
     reg : afc.gfeature.BlockRegion
         The feature to be counted.
-    sam_list : list of pysam.AlignmentFile
-        A list of file objects for input SAM/BAM files.
+    snp_reads : Iterator of tuple
+        The SNPs of the feature and the reads covering each of them,
+        returned by :func:`~afc.sam.SAMReader.fetch_snps`.
     snp_mcnt : afc.mcount_snp.MCount
         Counting object in SNP level.
     mcnt : afc.mcount_ab.MCount
@@ -230,8 +264,9 @@ def fc_ab(reg, sam_list, snp_mcnt, mcnt, conf):
         Return code. 0 if success, negative otherwise.
     """
     mcnt.add_feature(reg)
-    for snp in reg.snp_list:
-        ret = plp_snp(snp, sam_list, snp_mcnt, conf)
+
+    for snp, reads in snp_reads:
+        ret = plp_snp(snp, reads, snp_mcnt, conf)
         if ret < 0:
             error("SNP (%s:%d:%s:%s) pileup failed; errcode %d." % \
                 (snp.chrom, snp.pos, snp.ref, snp.alt, ret))
@@ -246,7 +281,7 @@ def fc_ab(reg, sam_list, snp_mcnt, mcnt, conf):
     return(0)
 
 
-def plp_snp(snp, sam_list, mcnt, conf):
+def plp_snp(snp, reads, mcnt, conf):
     """Counting in SNP level.
     
     This function generates UMI/read counts of the reference (REF) and 
@@ -256,8 +291,10 @@ def plp_snp(snp, sam_list, mcnt, conf):
     ----------
     snp : afc.gfeature.SNP
         The SNP to be counted.
-    sam_list : list of pysam.AlignmentFile
-        A list of file objects for input SAM/BAM files.
+    reads : list of tuple
+        The reads covering the SNP, each is a tuple of (idx, read), where
+        `idx` is the index of the input SAM/BAM file that the read
+        (pysam.AlignedSegment) comes from.
     mcnt : afc.mcount_snp.MCount
         Counting object in SNP level.
     conf : afc.config.Config
@@ -271,22 +308,14 @@ def plp_snp(snp, sam_list, mcnt, conf):
     ret = None
     if mcnt.add_snp(snp) < 0:   # mcnt reset() inside.
         return(-3)
-    for idx, sam in enumerate(sam_list):
-        itr = sam_fetch(sam, snp.chrom, snp.pos, snp.pos)
-        if not itr:    
+    use_barcodes = conf.use_barcodes()
+    for idx, read in reads:
+        sample = None if use_barcodes else conf.samples[idx]
+        ret = mcnt.push_read(read, sample)
+        if ret < 0:
+            return(-5)
+        elif ret > 0:    # read filtered.
             continue
-        for read in itr:
-            if check_read(read, conf) < 0:
-                continue
-            if conf.use_barcodes():
-                ret = mcnt.push_read(read)
-            else:
-                sample = conf.samples[idx]
-                ret = mcnt.push_read(read, sample)
-            if ret < 0:
-                return(-5)
-            elif ret > 0:    # read filtered.
-                continue
     if mcnt.stat() < 0:
         return(-7)
     snp_cnt = sum(mcnt.tcount)
@@ -298,3 +327,14 @@ def plp_snp(snp, sam_list, mcnt, conf):
     if snp_minor_cnt < snp_cnt * conf.min_maf:
         return(5)
     return(0)
+
+
+# BAM_READAHEAD_MAX_FILES : int
+#   The maximum number of input BAM files, for which the readahead (see
+#   :class:`~utils.sam.BAMReadahead`) is used.
+BAM_READAHEAD_MAX_FILES = 4
+
+# BAM_RELEASE_INTERVAL : int
+#   Number of features, after processing which the page cache of the
+#   passed-through part of the BAM files is released.
+BAM_RELEASE_INTERVAL = 100
@@ -26,8 +26,9 @@ from ..app import APP, VERSION
 from ..io.base import load_bams, load_barcodes, load_samples,  \
     load_list_from_str
 from ..io.counts import load_xdata
+from ..utils.base import shm_dump
 from ..utils.xlog import init_logging
-from ..utils.zfile import ZF_F_GZIP, ZF_F_PLAIN
+from ..utils.zfile import ZF_F_PLAIN
 
 
 def usage(fp = sys.stdout, conf = None):
@@ -53,6 +54,7 @@ def usage(fp = sys.stdout, conf = None):
     s += "      --UMItag STR       Tag for UMI, set to None when reads only [%s]\n" % conf.UMI_TAG
     #s += "      --minCOUNT INT     Minimum aggragated count for SNP [%d]\n" % conf.MIN_COUNT
     #s += "      --minMAF FLOAT     Minimum minor allele fraction for SNP [%f]\n" % conf.MIN_MAF
+    s += "      --bamTHREADS INT   Number of BAM decompression threads per process [%d]\n" % conf.BAM_DECOMP_THREADS
     s += "  -D, --debug INT        Used by developer for debugging [%d]\n" % conf.DEBUG
     s += "\n"
     s += "Read filtering:\n"
@@ -102,6 +104,7 @@ def afc_main(argv):
             "ncores=", 
             "cellTAG=", "UMItag=", 
             #"minCOUNT=", "minMAF=",
+            "bamTHREADS=",
             "debug=",
 
             "inclFLAG=", "exclFLAG=", "minLEN=", "minMAPQ=", "countORPHAN"
@@ -125,6 +128,7 @@ def afc_main(argv):
         elif op in (      "--umitag"): conf.umi_tag = val
         #elif op in (      "--mincount"): conf.min_count = int(val)
         #elif op in (      "--minmaf"): conf.min_maf = float(val)
+        elif op in (      "--bamthreads"): conf.bam_decomp_threads = int(val)
         elif op in ("-D", "--debug"): conf.debug = int(val)
 
         elif op in ("--inclflag"): conf.incl_flag = int(val)
@@ -153,7 +157,8 @@ def afc_wrapper(
     #min_count = 1, min_maf = 0,
     min_mapq = 20, min_len = 30,
     incl_flag = 0, excl_flag = -1,
-    no_orphan = True
+    no_orphan = True,
+    bam_decomp_threads = 2
 ):
     """Wrapper for running the afc (allele-specific counting) module.
 
@@ -219,6 +224,14 @@ def afc_wrapper(
         Value -1 means setting it to 772 when using UMI, or 1796 otherwise.
     no_orphan : bool, default True
         If `False`, do not skip anomalous read pairs.
+    bam_decomp_threads : int, default 2
+        Number of threads used for decompressing the input BAM file(s),
+        in each process.
+        They are extra threads on top of `ncores`, i.e., up to
+        ``ncores * bam_decomp_threads`` more threads in total.
+        The threads are shared by the BAM files, as each opened file has
+        its own thread pool; files get no extra threads if there are more
+        files than threads.
 
     Returns
     -------
@@ -252,6 +265,8 @@ def afc_wrapper(
     conf.excl_flag = excl_flag
     conf.no_orphan = no_orphan
 
+    conf.bam_decomp_threads = bam_decomp_threads
+
     ret, res = afc_run(conf)
     return((ret, res))
 
@@ -275,7 +290,7 @@ def afc_core(conf):
     for reg in conf.reg_list:
         snp_list = conf.snp_set.fetch(reg.chrom, reg.start, reg.end)
         if snp_list and len(snp_list) > 0:
-            reg.snp_list = snp_list
+            reg.snp_list = sorted(snp_list, key = lambda snp: snp.pos)
             n_reg_with_snp += 1
         else:
             reg.snp_list = []
@@ -290,8 +305,8 @@ def afc_core(conf):
     assign_feature_batch(conf, batch_size = 1000)
 
 
-    # split feature list and save to file.
-    info("split feature list and save to file ...")
+    # split feature list and pass to sub-processes via shared memory.
+    info("split feature list and save to shared memory ...")
 
     with open(conf.out_feature_meta_fn, "wb") as fp:
         pickle.dump(conf.reg_list, fp)
@@ -304,13 +319,19 @@ def afc_core(conf):
     else:
         n_reg = m_reg // m_thread + 1
 
+    reg_shm_list = []
     reg_fn_list = []
     for idx, i in enumerate(range(0, m_reg, n_reg)):
-        reg_fn = conf.out_prefix + "feature.pickle." + str(idx)
-        reg_fn = os.path.join(conf.out_dir, reg_fn)
+        reg_shm = shm_dump(conf.reg_list[i:(i+n_reg)])
+        reg_fn = None
+        if reg_shm is None:       # fall back to file.
+            warn("not enough shared memory, save feature list to file.")
+            reg_fn = conf.out_prefix + "feature.pickle." + str(idx)
+            reg_fn = os.path.join(conf.out_dir, reg_fn)
+            with open(reg_fn, "wb") as fp:
+                pickle.dump(conf.reg_list[i:(i+n_reg)], fp)
+        reg_shm_list.append(reg_shm)
         reg_fn_list.append(reg_fn)
-        with open(reg_fn, "wb") as fp:
-            pickle.dump(conf.reg_list[i:(i+n_reg)], fp)
 
     for reg in conf.reg_list:  # save memory
         del reg
@@ -329,6 +350,7 @@ def afc_core(conf):
     for i in range(m_thread):
         thdata = ThreadData(
             idx = i, conf = conf,
+            reg_obj_shm = reg_shm_list[i],
             reg_obj_fn = reg_fn_list[i],
             out_feature_fn = conf.out_feature_fn + "." + str(i),
             out_ale_fns = {ale: fn + "." + str(i) for ale, fn in \
@@ -361,6 +383,13 @@ def afc_core(conf):
             error("error code for thread-%d: %d" % (thdata.idx, thdata.ret))
             raise ValueError
 
+    err_reg = [x for thdata in thdata_list for x in thdata.err_reg]
+    if len(err_reg) > 0:
+        for name, ret in err_reg:
+            error("feature '%s' failed; errcode %d." % (name, ret))
+        error("%d features failed in counting." % len(err_reg))
+        raise ValueError
+
 
     # merge count matrices.
     info("merge output count matrices ...")
@@ -368,7 +397,7 @@ def afc_core(conf):
     nr_reg_list = [td.nr_reg for td in thdata_list]
     for ale in conf.out_ale_fns.keys():
         if merge_mtx(
-            [td.out_ale_fns[ale] for td in thdata_list], ZF_F_GZIP,
+            [td.out_ale_fns[ale] for td in thdata_list], ZF_F_PLAIN,
             conf.out_ale_fns[ale], "w", ZF_F_PLAIN,
             nr_reg_list, len(conf.samples),
             sum([td.nr_ale[ale] for td in thdata_list]),
@@ -545,6 +574,7 @@ def prepare_config(conf):
             if not conf.reg_list:
                 error("failed to load feature file.")
                 return(-1)
+            sort_features(conf.reg_list)
             info("count %d features in %d single cells." % (
                 len(conf.reg_list), len(conf.samples)))
         else:
@@ -602,6 +632,11 @@ def prepare_config(conf):
             fp.write("%s\t%d\t%d\t%s\n" % \
                     (reg.chrom, reg.start, reg.end - 1, reg.name))
 
+    if conf.bam_decomp_threads < 1:
+        error("invalid number of BAM decompression threads '%d'." % \
+            conf.bam_decomp_threads)
+        return(-1)
+
     if conf.excl_flag < 0:
         if conf.use_umi():
             conf.excl_flag = conf.defaults.EXCL_FLAG_UMI
@@ -615,6 +650,30 @@ def show_progress(rv = None):
     return(rv)
 
 
+def sort_features(reg_list):
+    """Sort features by genomic position, in place.
+
+    Features are sorted by their start (and end) positions within each
+    chromosome, so that each process visits the input BAM(s) in order.
+    The chromosomes are kept in the order they first appear in `reg_list`.
+
+    Parameters
+    ----------
+    reg_list : list of afc.gfeature.BlockRegion
+        A list of features.
+    
+    Returns
+    -------
+    Void.
+    """
+    chrom_idx = {}
+    for reg in reg_list:
+        if reg.chrom not in chrom_idx:
+            chrom_idx[reg.chrom] = len(chrom_idx)
+    reg_list.sort(key = lambda reg: \
+        (chrom_idx[reg.chrom], reg.start, reg.end))
+
+
 def assign_feature_batch(conf, batch_size = 1000):
     """Assign features into several batches.
 
@@ -213,9 +213,15 @@ class MCount:
                 return(-2)
             self.cell_cnt[smp] = SCount(self, self.conf)
 
+        # hit_samples : list of str
+        #   The samples having UMIs/reads covering SNPs in current feature.
+        self.hit_samples = []
+
         # is_reset : bool
         #   Whether this object has been reset.
+        #   All counting data is empty at the beginning.
         self.is_reset = False
+        self.mark_reset_true(recursive = True)
 
     def add_feature(self, reg):
         """Add one feature to be counted.
@@ -232,7 +238,7 @@ class MCount:
         """
         self.reset()
         self.reg = reg
-        self.mark_reset_false()
+        self.mark_reset_false(recursive = False)
         return(0)
     
     def mark_reset_false(self, recursive = True):
@@ -264,11 +270,14 @@ class MCount:
         int
             Return code. 0 if success, -1 otherwise.
         """
-        for smp, snp_scnt in snp_mcnt.cell_cnt.items():
+        for smp in snp_mcnt.hit_samples:    # other cells have no UMIs.
             if smp not in self.cell_cnt:
                 return(-1)
             scnt = self.cell_cnt[smp]
-            if scnt.push_snp(snp_scnt) < 0:
+            if scnt.is_reset:     # first SNP of this cell in current feature.
+                scnt.mark_reset_false()
+                self.hit_samples.append(smp)
+            if scnt.push_snp(snp_mcnt.cell_cnt[smp]) < 0:
                 return(-1)
         return(0)
 
@@ -276,13 +285,13 @@ class MCount:
         if self.is_reset:
             return
         self.reg = None
-        if self.cell_cnt:
-            for scnt in self.cell_cnt.values():
-                scnt.reset()
+        for smp in self.hit_samples:
+            self.cell_cnt[smp].reset()
+        self.hit_samples.clear()
         self.mark_reset_true()
 
     def stat(self):
-        for smp in self.samples:
+        for smp in self.hit_samples:
             scnt = self.cell_cnt[smp]
             if scnt.stat() < 0:
                 return(-1)
@@ -1,5 +1,7 @@
 # mcount_feature.py - counting machine for features (all allele types).
 
+import numpy as np
+
 
 class SCount:
     """Counting for single cell.
@@ -36,6 +38,10 @@ class SCount:
         self.mcnt = mcnt
         self.conf = conf
 
+        # umi_tag : str or None
+        #   The UMI tag, None if using read query names instead.
+        self.umi_tag = conf.umi_tag if conf.use_umi() else None
+
         # ab : afc.mcount_ab.SCount
         #   The object containing the feature counting results (mainly of
         #   haplotype A and B) in this cell.
@@ -100,11 +106,10 @@ class SCount:
         int
             The haplotype index of this read.
         """
-        conf = self.conf
         umi = None
         hap_idx = None
-        if conf.use_umi():
-            umi = read.get_tag(conf.umi_tag)
+        if self.umi_tag is not None:
+            umi = read.get_tag(self.umi_tag)
         else:
             umi = read.query_name
         if not umi:
@@ -153,6 +158,10 @@ class MCount:
         self.samples = samples
         self.conf = conf
 
+        # cell_tag : str or None
+        #   The cell tag, None if using sample IDs instead.
+        self.cell_tag = conf.cell_tag if conf.use_barcodes() else None
+
         # reg : afc.gfeature.BlockRegion
         #   The feature to be counted.
         self.reg = None
@@ -173,9 +182,30 @@ class MCount:
                 return(-2)
             self.cell_cnt[smp] = SCount(self, self.conf)
 
+        # sample_idx : dict of {str : int}
+        #   The 0-based index of each sample in `samples`, i.e., its row
+        #   index in `hap_cnt`.
+        self.sample_idx = {smp:i for i, smp in enumerate(self.samples)}
+
+        # hit_samples : list of str
+        #   The samples having reads in current feature.
+        self.hit_samples = []
+
+        # hap_cnt : numpy.ndarray of int
+        #   The *cell x haplotype* UMI/read counts, of shape 
+        #   (n_samples, 6), updated by :func:`stat`.
+        #   Rows are in the same order as `samples`, and the column of one
+        #   haplotype is its haplotype index in UMI level (see
+        #   :class:`~afc.mcount_feature.SCount`), i.e., columns 0, 1, 2,
+        #   -1, -2, -3 (negative indexing) for haplotypes A, B, D, O, 
+        #   and the two kinds of U, respectively.
+        self.hap_cnt = np.zeros((len(self.samples), 6), dtype = np.int64)
+
         # is_reset : bool
         #   Whether this object has been reset.
+        #   All counting data is empty at the beginning.
         self.is_reset = False
+        self.mark_reset_true(recursive = True)
 
     def add_feature(self, reg, ab):
         """Add one feature to be counted.
@@ -196,9 +226,6 @@ class MCount:
         self.reset()
         self.reg = reg
         self.ab = ab
-        for smp in self.samples:
-            scnt_ab = ab.cell_cnt[smp]
-            self.cell_cnt[smp].add_ab(scnt_ab)
         self.mark_reset_false(recursive = False)
         return(0)
     
@@ -239,11 +266,10 @@ class MCount:
         int
             The haplotype index of this read.
         """
-        conf = self.conf
         smp = None
         hap_idx = None
-        if conf.use_barcodes():
-            smp = read.get_tag(conf.cell_tag)
+        if self.cell_tag is not None:
+            smp = read.get_tag(self.cell_tag)
         else:
             smp = sid
         scnt = None
@@ -251,6 +277,9 @@ class MCount:
             scnt = self.cell_cnt[smp]
         else:
             return((1, smp, None, hap_idx))
+        if scnt.is_reset:     # first read of this cell in current feature.
+            scnt.add_ab(self.ab.cell_cnt[smp])
+            self.hit_samples.append(smp)
 
         ret, umi, hap_idx = scnt.push_read(read)
         if ret < 0: 
@@ -264,14 +293,23 @@ class MCount:
             return
         self.reg = None
         self.ab = None
-        if self.cell_cnt:
-            for scnt in self.cell_cnt.values():
-                scnt.reset()
+        if self.hit_samples:
+            for smp in self.hit_samples:
+                self.cell_cnt[smp].reset()
+            self.hap_cnt[[self.sample_idx[smp] for smp in \
+                self.hit_samples]] = 0
+            self.hit_samples.clear()
         self.mark_reset_true()
 
     def stat(self):
-        for smp in self.samples:
+        cnt = []
+        for smp in self.hit_samples:
             scnt = self.cell_cnt[smp]
             if scnt.stat() < 0:
                 return(-1)
+            hc = scnt.hap_cnt
+            cnt.append((hc[0], hc[1], hc[2], hc[-3], hc[-2], hc[-1]))
+        if cnt:
+            self.hap_cnt[[self.sample_idx[smp] for smp in \
+                self.hit_samples]] = cnt
         return(0)
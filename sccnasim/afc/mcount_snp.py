@@ -1,6 +1,6 @@
 # mcount_snp.py - counting machine for SNPs.
 
-from ..utils.sam import get_query_bases
+from ..utils.sam import get_query_base_at
 
 
 # TODO: UMI/read collapsing.
@@ -56,14 +56,12 @@ class UCount:
             Return code. 0 if success, -1 otherwise.
         """
         snp = self.scnt.mcnt.snp
-        try:
-            idx = read.positions.index(snp.pos - 1)
-        except:
+        base = get_query_base_at(read, snp.pos - 1)
+        if base is None:
             self.allele = None
             self.hap_idx = -2
         else:
-            bases = get_query_bases(read, full_length = False)
-            self.allele = bases[idx].upper()
+            self.allele = base.upper()
             self.hap_idx = snp.get_hap_idx(self.allele)
         return(0)
 
@@ -88,6 +86,10 @@ class SCount:
         self.mcnt = mcnt
         self.conf = conf
 
+        # umi_tag : str or None
+        #   The UMI tag, None if using read query names instead.
+        self.umi_tag = conf.umi_tag if conf.use_umi() else None
+
         # tcount : list of int
         #   The cell-wise total counts of reads/UMIs for A/C/G/T/N bases.
         self.tcount = [0] * 5
@@ -109,10 +111,9 @@ class SCount:
         self.is_reset = True
 
     def push_read(self, read):
-        conf = self.conf
         umi = None
-        if conf.use_umi():
-            umi = read.get_tag(conf.umi_tag)
+        if self.umi_tag is not None:
+            umi = read.get_tag(self.umi_tag)
         else:
             umi = read.query_name
         if not umi:
@@ -120,7 +121,7 @@ class SCount:
         if umi in self.umi_cnt:
             return(0)
         else:
-            ucnt = UCount(self, conf)
+            ucnt = UCount(self, self.conf)
             self.umi_cnt[umi] = ucnt
             ret = ucnt.push_read(read)
             if ret < 0:
@@ -169,6 +170,10 @@ class MCount:
         self.samples = samples
         self.conf = conf
 
+        # cell_tag : str or None
+        #   The cell tag, None if using sample IDs instead.
+        self.cell_tag = conf.cell_tag if conf.use_barcodes() else None
+
         # snp : afc.gfeature.SNP
         #   The SNP being pileuped.
         self.snp = None
@@ -192,9 +197,15 @@ class MCount:
                 return(-2)
             self.cell_cnt[smp] = SCount(self, self.conf)
 
+        # hit_samples : list of str
+        #   The samples having reads for current SNP.
+        self.hit_samples = []
+
         # is_reset : bool
         #   Whether this object has been reset.
+        #   All counting data is empty at the beginning.
         self.is_reset = False
+        self.mark_reset_true(recursive = True)
 
     def add_snp(self, snp):
         """Add one SNP to be pileuped.
@@ -211,7 +222,7 @@ class MCount:
         """
         self.reset()
         self.snp = snp
-        self.mark_reset_false()
+        self.mark_reset_false(recursive = False)
         return(0)
     
     def mark_reset_false(self, recursive = True):
@@ -242,9 +253,8 @@ class MCount:
         int
             Return code. 0 if success, -1 error, 1 read filtered. 
         """
-        conf = self.conf
-        if conf.use_barcodes():
-            smp = read.get_tag(conf.cell_tag)
+        if self.cell_tag is not None:
+            smp = read.get_tag(self.cell_tag)
         else:
             smp = sid
         scnt = None
@@ -252,6 +262,9 @@ class MCount:
             scnt = self.cell_cnt[smp]
         else:
             return(1)
+        if scnt.is_reset:     # first read of this cell for current SNP.
+            scnt.mark_reset_false()
+            self.hit_samples.append(smp)
 
         ret = scnt.push_read(read)
         if ret < 0: 
@@ -265,13 +278,13 @@ class MCount:
         if self.tcount:
             for i in range(len(self.tcount)):
                 self.tcount[i] = 0
-        if self.cell_cnt:
-            for scnt in self.cell_cnt.values():
-                scnt.reset()
+        for smp in self.hit_samples:
+            self.cell_cnt[smp].reset()
+        self.hit_samples.clear()
         self.mark_reset_true()
 
     def stat(self):
-        for smp in self.samples:
+        for smp in self.hit_samples:
             scnt = self.cell_cnt[smp]
             if scnt.stat() < 0:
                 return(-1)
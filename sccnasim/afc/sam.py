@@ -0,0 +1,124 @@
+# sam.py - fetching reads of features from SAM/BAM files.
+
+import heapq
+
+from ..utils.sam import check_read, sam_fetch
+
+
+class SAMReader:
+    """Reads of features from a list of SAM/BAM files.
+
+    The reads of one feature are served in two passes, each streamed from
+    the SAM/BAM files rather than held in memory:
+
+    * :func:`fetch_snps` fetches the range spanned by the SNPs of the
+      feature, and keeps only the reads covering the SNPs.
+    * :func:`fetch` fetches all reads of the feature, for feature-level
+      counting.
+    """
+    def __init__(self, sam_list, conf):
+        """
+        Parameters
+        ----------
+        sam_list : list of pysam.AlignmentFile
+            A list of file objects for input SAM/BAM files.
+        conf : afc.config.Config
+            Global configuration object.
+        """
+        self.sam_list = sam_list
+        self.conf = conf
+
+    def fetch(self, reg):
+        """Fetch the valid reads of one feature.
+
+        Parameters
+        ----------
+        reg : afc.gfeature.BlockRegion
+            The feature whose reads are to be fetched.
+
+        Returns
+        -------
+        list of Iterator of pysam.AlignedSegment
+            The reads (passing filtering) of each input SAM/BAM file, in the
+            same order as in the file, i.e., sorted by the start position.
+            Each iterator should be consumed before the next call of
+            :func:`fetch` or :func:`fetch_snps`.
+        """
+        return([self.__iter_reads(sam, reg.chrom, reg.start, reg.end - 1) \
+                for sam in self.sam_list])
+
+    def fetch_snps(self, reg):
+        """Fetch the valid reads covering each SNP of one feature.
+
+        The reads are swept along the SNPs, keeping only those covering
+        the current SNP, so that each read is visited once, however many
+        SNPs it covers.
+
+        Parameters
+        ----------
+        reg : afc.gfeature.BlockRegion
+            The feature whose SNPs are to be fetched. Its SNPs are sorted
+            by their positions.
+
+        Returns
+        -------
+        Iterator of tuple
+            Each element is a tuple of (snp, reads) for one SNP in
+            `reg.snp_list`, in the same order, where `reads` is a list of
+            the reads (passing filtering) covering the SNP, each is a tuple
+            of (idx, read), `idx` is the index of the input SAM/BAM file
+            that the read (pysam.AlignedSegment) comes from.
+            The reads are ordered by `idx`, then in the same order as in
+            the file.
+        """
+        snp_list = reg.snp_list
+        if len(snp_list) <= 0:
+            return
+        itrs = [self.__iter_starts(idx, self.__iter_reads(
+                    sam, reg.chrom, snp_list[0].pos, snp_list[-1].pos)) \
+                for idx, sam in enumerate(self.sam_list)]
+
+        # actives : list of list of tuple
+        #   The reads covering the current SNP in each file, each is a tuple
+        #   of (end, read).
+        actives = [[] for _ in range(len(self.sam_list))]
+        i, n = 0, len(snp_list)
+        pos = snp_list[0].pos - 1        # 0-based
+        for start, idx, read in heapq.merge(*itrs, key = lambda x: x[0]):
+            while start > pos:
+                yield((snp_list[i], self.__get_snp_reads(actives, pos)))
+                i += 1
+                if i >= n:
+                    return
+                pos = snp_list[i].pos - 1
+            end = read.reference_end
+            if end is None:    # same as htslib for reads without CIGAR.
+                end = start + 1
+            if end > pos:
+                actives[idx].append((end, read))
+        while i < n:
+            yield((snp_list[i], self.__get_snp_reads(actives, pos)))
+            i += 1
+            if i < n:
+                pos = snp_list[i].pos - 1
+
+    def __get_snp_reads(self, actives, pos):
+        reads = []
+        for idx, active in enumerate(actives):
+            if any(x[0] <= pos for x in active):
+                active[:] = [x for x in active if x[0] > pos]
+            reads.extend([(idx, x[1]) for x in active])
+        return(reads)
+
+    def __iter_starts(self, idx, reads):
+        for read in reads:
+            yield((read.reference_start, idx, read))
+
+    def __iter_reads(self, sam, chrom, start, end):
+        itr = sam_fetch(sam, chrom, start, end)
+        if not itr:
+            return
+        for read in itr:
+            if check_read(read, self.conf) < 0:
+                continue
+            yield read
@@ -6,6 +6,7 @@ class ThreadData:
     """Thread Data"""
     def __init__(self, 
         idx, conf, 
+        reg_obj_shm,
         reg_obj_fn,
         out_feature_fn,
         out_ale_fns
@@ -17,9 +18,15 @@ class ThreadData:
             The 0-based index of thread.
         conf : afc.config.Config
             The global configuration.
-        reg_obj_fn : str
-            Path to the python pickle file storing a list of features (
-            :class:`~afc.gfeature.BlockRegion` objects).
+        reg_obj_shm : tuple of (str, int) or None
+            The name and data size of the shared memory block storing a
+            pickled list of features (:class:`~afc.gfeature.BlockRegion` 
+            objects), see :func:`~utils.base.shm_dump`.
+            None if `reg_obj_fn` is used.
+        reg_obj_fn : str or None
+            Path to the python pickle file storing a list of features.
+            It is only used when the shared memory is not available, i.e.,
+            `reg_obj_shm` is None.
         out_feature_fn : str
             Path to the output feature TSV file in this thread.
         out_ale_fns : dict of {str : str}
@@ -29,6 +36,7 @@ class ThreadData:
         self.idx = idx
         self.conf = conf
 
+        self.reg_obj_shm = reg_obj_shm
         self.reg_obj_fn = reg_obj_fn
 
         self.out_feature_fn = out_feature_fn
@@ -44,6 +52,12 @@ class ThreadData:
         #   file(s).
         #   Keys are allele names, values are number of records.
         self.nr_ale = {ale:0 for ale in out_ale_fns.keys()}
+
+        # err_reg : list of tuple
+        #   The features failed to be counted, each is a tuple of 
+        #   (feature name, error code).
+        #   The process stops at the first failed feature.
+        self.err_reg = []
         
         # ret : int
         #   Return code. 0 if success, negative otherwise.
@@ -59,6 +73,7 @@ class ThreadData:
         s = "%s\n" % prefix
         s += "%sindex = %d\n" % (prefix, self.idx)
 
+        s += "%sreg_obj shm = %s\n" % (prefix, self.reg_obj_shm)
         s += "%sreg_obj filename = %s\n" % (prefix, self.reg_obj_fn)
 
         s += "%sout_feature_fn = %s\n" % (prefix, self.out_feature_fn)
@@ -68,6 +83,7 @@ class ThreadData:
         s += "%snum_record_feature = %d\n" % (prefix, self.nr_reg)
         for ale, nr in self.nr_ale.items():
             s += "%snum_record_%s = %d\n" % (prefix, ale, nr)
+        s += "%snum_failed_features = %d\n" % (prefix, len(self.err_reg))
 
         s += "%sreturn code = %d\n" % (prefix, self.ret)
         s += "%s\n" % prefix
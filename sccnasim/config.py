@@ -127,6 +127,14 @@ class Config:
         Value -1 means setting it to 772 when using UMI, or 1796 otherwise.
     no_orphan : bool, default True
         If `False`, do not skip anomalous read pairs.
+    bam_decomp_threads : int, default 2
+        Number of threads used for decompressing the input BAM file(s),
+        in each process of the ``afc`` module.
+        They are extra threads on top of `ncores`, i.e., up to
+        ``ncores * bam_decomp_threads`` more threads in ``afc``.
+        The threads are shared by the BAM files, as each opened file has
+        its own thread pool; files get no extra threads if there are more
+        files than threads.
     """
     def __init__(self):
         self.afc_def_conf = AFC_DefConf()
@@ -164,6 +172,7 @@ class Config:
         self.incl_flag = self.afc_def_conf.INCL_FLAG
         self.excl_flag = -1
         self.no_orphan = self.afc_def_conf.NO_ORPHAN
+        self.bam_decomp_threads = self.afc_def_conf.BAM_DECOMP_THREADS
 
     def show(self, fp = None, prefix = ""):
         if fp is None:
@@ -202,6 +211,7 @@ class Config:
         s += "%sinclude_flag = %d\n" % (prefix, self.incl_flag)
         s += "%sexclude_flag = %d\n" % (prefix, self.excl_flag)
         s += "%sno_orphan = %s\n" % (prefix, self.no_orphan)
+        s += "%sbam_decomp_threads = %d\n" % (prefix, self.bam_decomp_threads)
         s += "%s\n" % prefix
 
         fp.write(s)
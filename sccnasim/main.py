@@ -43,7 +43,8 @@ def main_wrapper(
     ncores = 1, verbose = False,
     min_mapq = 20, min_len = 30,
     incl_flag = 0, excl_flag = -1,
-    no_orphan = True
+    no_orphan = True,
+    bam_decomp_threads = 2
 ):
     """Wrapper for running the main pipeline.
 
@@ -169,6 +170,14 @@ def main_wrapper(
         Value -1 means setting it to 772 when using UMI, or 1796 otherwise.
     no_orphan : bool, default True
         If `False`, do not skip anomalous read pairs.
+    bam_decomp_threads : int, default 2
+        Number of threads used for decompressing the input BAM file(s),
+        in each process of the ``afc`` module.
+        They are extra threads on top of `ncores`, i.e., up to
+        ``ncores * bam_decomp_threads`` more threads in ``afc``.
+        The threads are shared by the BAM files, as each opened file has
+        its own thread pool; files get no extra threads if there are more
+        files than threads.
 
     Returns
     -------
@@ -225,6 +234,7 @@ def main_wrapper(
     conf.incl_flag = incl_flag
     conf.excl_flag = excl_flag
     conf.no_orphan = no_orphan
+    conf.bam_decomp_threads = bam_decomp_threads
 
 
     ret, res = main_run(conf)
@@ -281,7 +291,8 @@ def main_core(conf):
         min_len = conf.min_len,
         incl_flag = conf.incl_flag,
         excl_flag = conf.excl_flag,
-        no_orphan = conf.no_orphan
+        no_orphan = conf.no_orphan,
+        bam_decomp_threads = conf.bam_decomp_threads
     )
     if afc_ret < 0:
         error("allele-specific feature counting failed (%d)." % afc_ret)
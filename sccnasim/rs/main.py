@@ -601,8 +601,13 @@ def rs_core_chrom(thdata):
 
 
     # index the output BAM files.
+    # the cores not taken by the chromosome processes, if any, are shared by
+    # them as htslib threads.
+    # Index the files one by one, as pool workers cannot have sub-processes.
     info("[chrom-%s] index output BAM file(s) ..." % thdata.chrom)
-    sam_index(thdata.out_sam_fn_list, ncores = 1)
+    ncores = max(conf.ncores // min(conf.ncores, len(conf.chrom_list)), 1)
+    for sam_fn in thdata.out_sam_fn_list:
+        sam_index([sam_fn], ncores = ncores)
 
     thdata.ret = 0
     return((0, thdata))
@@ -2,8 +2,8 @@
 
 import pysam
 from ..utils.grange import format_chrom
-from ..utils.sam import sam_fetch, sam_merge, \
-    BAM_FPAIRED, BAM_FPROPER_PAIR
+from ..utils.sam import get_aligned_length, sam_fetch, sam_merge, \
+    BAM_FPAIRED, BAM_FPAIR_MASK
 from ..utils.xbarcode import Barcode
 
 
@@ -106,14 +106,14 @@ class SAMInput:
     
     def check_read2(self, read):
         # partial filtering to speed up.
-        if self.excl_flag and read.flag & self.excl_flag:
+        flag = read.flag
+        if flag & self.excl_flag:
             return(-3)
-        if self.incl_flag and not read.flag & self.incl_flag:
+        if self.incl_flag and not flag & self.incl_flag:
             return(-4)
-        if self.no_orphan and read.flag & BAM_FPAIRED and not \
-            read.flag & BAM_FPROPER_PAIR:
+        if self.no_orphan and (flag & BAM_FPAIR_MASK) == BAM_FPAIRED:
             return(-5)
-        if len(read.positions) < self.min_len:
+        if get_aligned_length(read) < self.min_len:
             return(-21)
         return(0)
 
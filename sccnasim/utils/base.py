@@ -3,6 +3,8 @@
 
 import numpy as np
 import os
+import pickle
+from multiprocessing import shared_memory
 
 
 def assert_e(path):
@@ -33,3 +35,72 @@ def is_file_empty(fn):
     """Test whether file is empty."""
     assert os.path.exists(fn)
     return(os.path.getsize(fn) <= 0)
+
+
+def shm_dump(obj):
+    """Pickle object into a new block of shared memory.
+
+    It is used to pass large objects to sub-processes without writing them
+    to disk.
+    The block is closed but not unlinked; it should be released by
+    :func:`shm_load` (typically in the sub-process).
+
+    Parameters
+    ----------
+    obj : object
+        The object to be pickled.
+
+    Returns
+    -------
+    tuple of (str, int) or None
+        The name of the shared memory block and the size of the pickled
+        data. None if there is not enough shared memory.
+    """
+    data = pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL)
+    size = len(data)
+    try:
+        # on Linux, writing beyond the free space of /dev/shm crashes the
+        # process (SIGBUS), hence check it beforehand.
+        st = os.statvfs("/dev/shm")
+    except OSError:
+        pass
+    else:
+        if st.f_bavail * st.f_frsize < size:
+            return(None)
+    try:
+        shm = shared_memory.SharedMemory(create = True, size = max(size, 1))
+    except OSError:
+        return(None)
+    shm.buf[:size] = data
+    name = shm.name
+    shm.close()
+    return((name, size))
+
+
+def shm_load(name, size, unlink = True):
+    """Load object pickled by :func:`shm_dump`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block.
+    size : int
+        The size of the pickled data.
+    unlink : bool, default True
+        Whether to release the shared memory block after loading.
+
+    Returns
+    -------
+    object
+        The loaded object.
+    """
+    shm = shared_memory.SharedMemory(name = name)
+    buf = shm.buf[:size]
+    try:
+        obj = pickle.loads(buf)
+    finally:
+        buf.release()     # no exported pointers are allowed in close().
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return(obj)
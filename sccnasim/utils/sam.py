@@ -1,9 +1,11 @@
 # sam.py - sam alignment processing.
 
 
+import functools
 import multiprocessing
 import os
 import pysam
+import re
 import subprocess
 from logging import error
 
@@ -29,22 +31,50 @@ def check_read(read, conf):
     """
     if read.mapq < conf.min_mapq:
         return(-2)
-    if conf.excl_flag and read.flag & conf.excl_flag:
+    flag = read.flag    # fetch once; each access crosses the pysam boundary.
+    if flag & conf.excl_flag:
         return(-3)
-    if conf.incl_flag and not read.flag & conf.incl_flag:
+    if conf.incl_flag and not flag & conf.incl_flag:
         return(-4)
-    if conf.no_orphan and read.flag & BAM_FPAIRED and not \
-        read.flag & BAM_FPROPER_PAIR:
+    if conf.no_orphan and (flag & BAM_FPAIR_MASK) == BAM_FPAIRED:
         return(-5)
     if conf.cell_tag and not read.has_tag(conf.cell_tag):
         return(-11)
     if conf.umi_tag and not read.has_tag(conf.umi_tag):
         return(-12)
-    if len(read.positions) < conf.min_len:
+    if get_aligned_length(read) < conf.min_len:
         return(-21)
     return(0)
 
 
+def get_aligned_length(read):
+    """Number of aligned bases of the read.
+
+    It is equal to `len(read.positions)`, i.e., the total length of the
+    M/=/X CIGAR operations, but without building the list of positions.
+    Note that it is different from `read.reference_length`, which also
+    counts deletions (D) and skipped regions (N).
+
+    Parameters
+    ----------
+    read : pysam.AlignedSegment
+        One alignment read.
+
+    Returns
+    -------
+    int
+        The number of aligned bases.
+    """
+    cigar_tuples = read.cigartuples
+    if not cigar_tuples:
+        return(0)
+    n = 0
+    for op, l in cigar_tuples:
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            n += l
+    return(n)
+
+
 def get_query_bases(read, full_length = False):
     """Qurey bases that are within the alignment.
 
@@ -62,26 +92,11 @@ def get_query_bases(read, full_length = False):
     list of str
         A list of bases in qurey sequence that are within the alignment.
     """
-    cigar_tuples = read.cigartuples
-    if not cigar_tuples:
+    cigar_string = read.cigarstring
+    if not cigar_string:
         return []
-
-    result = []
-    pos = 0
-    s = read.query_sequence
-
-    for op, l in cigar_tuples:
-        if op == BAM_CSOFT_CLIP or op == BAM_CINS:
-            if full_length:
-                for i in range(0, l):
-                    result.append(None)
-            pos += l
-        elif op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
-            for i in range(pos, pos + l):
-                result.append(s[i])
-            pos += l
-        # else: do nothing.
-    return result
+    return __get_query_values(
+        _parse_cigar(cigar_string), read.query_sequence, full_length)
 
 
 def get_query_qualities(read, full_length = False):
@@ -104,28 +119,228 @@ def get_query_qualities(read, full_length = False):
         typically seen in FASTQ or SAM formatted files, no need to 
         substract 33.
     """
-    cigar_tuples = read.cigartuples
-    if not cigar_tuples:
+    cigar_string = read.cigarstring
+    if not cigar_string:
         return []
+    return __get_query_values(
+        _parse_cigar(cigar_string), read.query_qualities, full_length)
 
-    result = []
-    pos = 0
-    s = read.query_qualities
 
-    for op, l in cigar_tuples:
+def get_query_base_at(read, pos):
+    """Query base aligned to one reference position.
+
+    It is equivalent to indexing `get_query_bases(read)` by the index of
+    `pos` in `read.positions`, but only locates the CIGAR block covering
+    `pos`, without building the two lists.
+
+    Parameters
+    ----------
+    read : pysam.AlignedSegment
+        One alignment read.
+    pos : int
+        The 0-based reference position.
+
+    Returns
+    -------
+    str or None
+        The query base aligned to `pos`.
+        None if `pos` is not within the aligned (M/=/X) blocks of the read,
+        e.g., in a deletion or skipped region, or the read has no sequence.
+    """
+    cigar_string = read.cigarstring
+    seq = read.query_sequence
+    if not cigar_string or seq is None:
+        return None
+    offset = pos - read.reference_start
+    if offset < 0:
+        return None
+    for op, l, qpos, rpos in _parse_cigar(cigar_string):
+        if rpos > offset:
+            break
+        if offset < rpos + l and \
+            (op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF):
+            return seq[qpos + offset - rpos]
+    return None
+
+
+def __get_query_values(cigar_blocks, s, full_length):
+    result = []
+    for op, l, qpos, _ in cigar_blocks:
         if op == BAM_CSOFT_CLIP or op == BAM_CINS:
             if full_length:
-                for i in range(0, l):
-                    result.append(None)
-            pos += l
+                result.extend([None] * l)
         elif op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
-            for i in range(pos, pos + l):
-                result.append(s[i])
-            pos += l
+            result.extend(s[qpos:(qpos + l)])
         # else: do nothing.
     return result
 
 
+@functools.lru_cache(maxsize = 4096)
+def _parse_cigar(cigar_string):
+    """Parse the CIGAR string into blocks.
+
+    The results are cached, as reads from one BAM file typically share a
+    small number of distinct CIGAR strings.
+
+    Parameters
+    ----------
+    cigar_string : str
+        The CIGAR string, e.g., "10S80M1000N20M".
+
+    Returns
+    -------
+    tuple of tuple
+        Each element is a tuple of (op, len, qpos, rpos) for one CIGAR
+        operation, where `qpos` and `rpos` are the 0-based offsets of the
+        operation in the query sequence and on the reference (relative to
+        the reference start of the read), respectively.
+    """
+    blocks = []
+    qpos = rpos = 0
+    for l, c in _CIGAR_RE.findall(cigar_string):
+        op = CIGAR_OPS.index(c)
+        l = int(l)
+        blocks.append((op, l, qpos, rpos))
+        if op in CIGAR_QUERY_OPS:
+            qpos += l
+        if op in CIGAR_REF_OPS:
+            rpos += l
+    return tuple(blocks)
+
+
+class BAMReadahead:
+    """Readahead hints for one BAM file being fetched region by region.
+
+    htslib reads BAM files in small blocks, which the kernel readahead
+    (128 KB by default) does not cover well when many nearby regions are
+    fetched in turn.
+    This class asks the kernel, via `posix_fadvise()`, to load the next
+    `size` bytes after the current read position into the page cache in
+    the background.
+    It can also ask the kernel to drop the pages that have been passed
+    through, to keep the page cache for the regions still to be fetched
+    (e.g., by other processes).
+    It does nothing if `posix_fadvise()` is not available (non-Linux) or 
+    the file is not BGZF-compressed BAM.
+    """
+    def __init__(self, sam_fn, sam, size = None):
+        """
+        Parameters
+        ----------
+        sam_fn : str
+            Path to the BAM file.
+        sam : pysam.AlignmentFile
+            The opened file object of `sam_fn`.
+        size : int or None, default None
+            Number of bytes to read ahead.
+            If None, set to `BAM_READAHEAD_SIZE`.
+        """
+        self.sam = sam
+        self.size = size if size else BAM_READAHEAD_SIZE
+
+        # fd : int or None
+        #   A separate file descriptor of the BAM file, used for advising
+        #   the (shared) page cache.
+        #   None if readahead is not supported.
+        self.fd = None
+        if hasattr(os, "posix_fadvise") and sam.is_bam:
+            try:
+                self.fd = os.open(sam_fn, os.O_RDONLY)
+            except OSError:
+                self.fd = None
+
+        # chrom : str or None
+        #   The chromosome of the last region, given to :func:`prefetch`.
+        self.chrom = None
+
+        # last_offset : int or None
+        #   The file offset when :func:`prefetch` was last called.
+        self.last_offset = None
+
+        # rel_start : int or None
+        #   The file offset from which the pages have not been released,
+        #   i.e., the position just after the first region (on current
+        #   chromosome), or the end of the last released range.
+        self.rel_start = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def prefetch(self, chrom = None):
+        """Read ahead from the current position of `sam`.
+
+        Parameters
+        ----------
+        chrom : str or None, default None
+            The chromosome of the region just fetched.
+            When it changes, the pages of the last chromosome are released
+            and the range to be released restarts from here, as the
+            new chromosome may be anywhere in the file and the bytes in
+            between may be read by other processes.
+
+        Returns
+        -------
+        Void.
+        """
+        offset = self.tell()
+        if offset is None:
+            return
+        if chrom != self.chrom:
+            if self.rel_start is not None:
+                self.__drop(self.rel_start, self.last_offset)
+            self.chrom = chrom
+            self.rel_start = offset
+        self.last_offset = offset
+        os.posix_fadvise(self.fd, offset, self.size, os.POSIX_FADV_WILLNEED)
+
+    def release(self):
+        """Drop the pages passed through from the page cache.
+
+        The range from `rel_start` up to `size` bytes before the current
+        position of `sam` is released, leaving a margin for the next
+        regions, which may start slightly before the current position.
+
+        Returns
+        -------
+        Void.
+        """
+        offset = self.tell()
+        if offset is None:
+            return
+        if self.rel_start is None or offset < self.rel_start:
+            # not prefetched yet, or jumped backward.
+            self.rel_start = offset
+            return
+        end = offset - self.size
+        if end <= self.rel_start:
+            return
+        self.__drop(self.rel_start, end)
+        self.rel_start = end
+
+    def __drop(self, start, end):
+        if end > start:
+            os.posix_fadvise(self.fd, start, end - start,
+                os.POSIX_FADV_DONTNEED)
+
+    def tell(self):
+        """Get the current (compressed) file offset of `sam`.
+
+        Returns
+        -------
+        int or None
+            The file offset, None if not available.
+        """
+        if self.fd is None:
+            return(None)
+        try:
+            voffset = self.sam.tell()
+        except (OSError, ValueError):
+            return(None)
+        return(voffset >> 16)    # BGZF virtual offset to block offset.
+
+
 def sam_fetch(sam, chrom, start = None, end = None):
     """Wrapper for pysam.fetch method that could automatically handle 
     chromosome names with or without the "chr" prefix.
@@ -150,24 +365,26 @@ def sam_fetch(sam, chrom, start = None, end = None):
     if start is not None:
         start = start - 1
 
-    try:   
-        itr = sam.fetch(chrom, start, end)
-    except:
-        pass
-    else:
-        if itr:
-            return itr
-    chrom = chrom[3:] if chrom.startswith("chr") else "chr" + chrom
+    # look up the chromosome name in the header first, instead of trying
+    # `sam.fetch()` and catching the exception, which is costly when the
+    # other naming convention ("chr" prefix or not) is used in the BAM.
+    if sam.get_tid(chrom) < 0:
+        chrom = chrom[3:] if chrom.startswith("chr") else "chr" + chrom
+        if sam.get_tid(chrom) < 0:
+            return None
     try:
         itr = sam.fetch(chrom, start, end)
-    except:
+    except ValueError:    # e.g., invalid coordinates or no index.
         return None
-    else:
-        return itr if itr else None
+    return itr if itr else None
     
 
 def sam_index(sam_fn_list, ncores = 1):
     """Index BAM file(s).
+
+    The `ncores` cores are shared by files indexed in parallel (processes)
+    and the htslib threads used in indexing each file, e.g., with 8 cores,
+    2 files are indexed with 4 threads each, rather than using 2 cores only.
     
     Parameters
     ----------
@@ -181,16 +398,19 @@ def sam_index(sam_fn_list, ncores = 1):
     int
         Return code. 0 if success, negative otherwise.
     """
-    if ncores == 1:
+    n_sam = len(sam_fn_list)
+    n_proc = max(min(ncores, n_sam), 1)
+    nthreads = max(ncores // n_proc, 1)
+    if n_proc == 1:
         for sam_fn in sam_fn_list:
-            pysam.index(sam_fn)
+            __sam_index1(sam_fn, nthreads)
     else:
-        pool = multiprocessing.Pool(processes = ncores)
+        pool = multiprocessing.Pool(processes = n_proc)
         mp_res = []
         for sam_fn in sam_fn_list:
             mp_res.append(pool.apply_async(
-                func = pysam.index,
-                args = (sam_fn, ),
+                func = __sam_index1,
+                args = (sam_fn, nthreads),
                 callback = None
             ))
         pool.close()
@@ -198,6 +418,14 @@ def sam_index(sam_fn_list, ncores = 1):
     return(0)
 
 
+def __sam_index1(sam_fn, nthreads = 1):
+    if nthreads > 1:
+        # the "-@" option of "samtools index" sets the additional threads.
+        pysam.index("-@", str(nthreads - 1), sam_fn)
+    else:
+        pysam.index(sam_fn)
+
+
 def sam_merge(in_fn_list, out_fn):
     """Merge BAM files.
 
@@ -269,6 +497,10 @@ def sam_sort_by_tag(in_bam, tag, out_bam = None, max_mem = "4G", nthreads = 1):
 BAM_FPAIRED = 1
 BAM_FPROPER_PAIR = 2
 
+# orphan reads, i.e., paired but not properly paired, are those with
+# `(flag & BAM_FPAIR_MASK) == BAM_FPAIRED`.
+BAM_FPAIR_MASK = BAM_FPAIRED | BAM_FPROPER_PAIR
+
 # Cigar
 # reference: https://pysam.readthedocs.io/en/latest/api.html#pysam.AlignedSegment.cigartuples
 BAM_CMATCH = 0
@@ -281,3 +513,19 @@ BAM_CPAD = 6
 BAM_CEQUAL = 7
 BAM_CDIFF = 8
 BAM_CBACK = 9
+
+# CIGAR_OPS : str
+#   The CIGAR operation characters, ordered by their BAM_CXXX codes.
+CIGAR_OPS = "MIDNSHP=XB"
+
+# CIGAR_QUERY_OPS, CIGAR_REF_OPS : tuple of int
+#   CIGAR operations that consume the query and the reference, respectively.
+CIGAR_QUERY_OPS = (BAM_CMATCH, BAM_CINS, BAM_CSOFT_CLIP, BAM_CEQUAL, BAM_CDIFF)
+CIGAR_REF_OPS = (BAM_CMATCH, BAM_CDEL, BAM_CREF_SKIP, BAM_CEQUAL, BAM_CDIFF)
+
+_CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=XB])")
+
+
+# BAM_READAHEAD_SIZE : int
+#   Default number of bytes to read ahead in :class:`BAMReadahead`.
+BAM_READAHEAD_SIZE = 4194304   # 4M
@@ -41,9 +41,15 @@ class ZFile:
         #   The file object.
         self.fp = None
 
-        # buf : str or bytes
-        #   The buffer.
-        self.buf = self.__reset_buf()
+        # buf : list of str or list of bytes
+        #   The buffer, i.e., the data chunks to be written.
+        #   They are joined only when being flushed, as concatenating
+        #   each chunk to one string copies the whole buffer every time.
+        self.buf = []
+
+        # buf_size : int
+        #   The total length of the data chunks in `buf`.
+        self.buf_size = 0
 
         if file_type == ZF_F_AUTO:
             fn = file_name.lower()
@@ -79,14 +85,16 @@ class ZFile:
             raise StopIteration()
         return(line)
 
-    def __reset_buf(self):
-        return(bytes("", self.encoding) if self.is_bytes else "")
+    def __flush_buf(self):
+        data = (b"" if self.is_bytes else "").join(self.buf)
+        self.buf.clear()
+        self.buf_size = 0
+        return(self.fp.write(data))
 
     def close(self):
         if self.fp:
             if self.buf:
-                self.fp.write(self.buf)
-                self.buf = None
+                self.__flush_buf()
             self.fp.close()
             self.fp = None
 
@@ -117,11 +125,10 @@ class ZFile:
     def write(self, data):
         if not self.fp:
             raise OSError()
-        self.buf += data
-        if len(self.buf) >= ZF_BUFSIZE:
-            ret = self.fp.write(self.buf)
-            self.buf = self.__reset_buf()
-            return(ret)
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= ZF_BUFSIZE:
+            return(self.__flush_buf())
         return(len(data))
 
 def zopen(file_name, mode, file_type = None, is_bytes = False, encoding = None):